@@ -9,13 +9,179 @@ High-level APIs for building data generators. These produce batches of data on-t
 fit_generator() methods.
 """
 
+import os
+import hashlib
+import tempfile
+import threading
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import xarray as xr
 import tensorflow as tf
 from tensorflow.keras.utils import Sequence
 from ..util import delete_nan_samples, insolation, to_bool
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _time_windows(array, time_steps, interval=1):
+    """
+    Produce a view of an array containing windows of consecutive time steps along the first (time) axis. No data are
+    copied until the view is indexed.
+
+    :param array: ndarray: array with time as the first dimension
+    :param time_steps: int: number of time steps in each window
+    :param interval: int: number of steps between each time step in a window
+    :return: ndarray: read-only view of shape (n_window, time_steps, ...)
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(array, interval * (time_steps - 1) + 1, axis=0)
+    return np.moveaxis(windows[..., ::interval], -1, 1)
+
+
+def _contiguous_time_steps(da, dtype=None):
+    """
+    Get a DataArray with the same data as da, stored so that the data at each index along the first (time) axis are
+    a single contiguous block. The data are only copied if they are not already stored this way.
+
+    :param da: xarray DataArray: loaded data
+    :param dtype: numpy dtype or None: if given, the type of the data, which are copied if da has another type
+    :return: xarray DataArray
+    """
+    values = da.values
+    if (len(values) == 0 or values[0].flags.c_contiguous) and (dtype is None or values.dtype == dtype):
+        return da
+    return da.copy(deep=False, data=np.ascontiguousarray(values, dtype=dtype))
+
+
+def _any_nan(array, batch_size=1024):
+    """
+    Find the indices along the first axis of an array which contain any NaN. Works in batches along the first axis to
+    limit memory use.
+
+    :param array: ndarray: array to check
+    :param batch_size: int: number of indices along the first axis to check at a time
+    :return: ndarray: 1-d boolean array, True where there are NaNs
+    """
+    array = array.reshape((array.shape[0], -1))
+    result = np.zeros(array.shape[0], dtype=bool)
+    for i in range(0, array.shape[0], batch_size):
+        result[i:i + batch_size] = np.isnan(array[i:i + batch_size]).any(axis=1)
+    return result
+
+
+def _to_npy(da, path, dtype=None, batch_size=256):
+    """
+    Write the data of a DataArray to a .npy file, reading batches along the first axis so that the full array is never
+    held in memory, and open the file as a read-only memory-map.
+
+    :param da: xarray DataArray: data to write
+    :param path: str: path to the .npy file
+    :param dtype: numpy dtype or None: type of the data in the file; defaults to that of da
+    :param batch_size: int: number of indices along the first axis to read at a time
+    :return: numpy memmap
+    """
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype or da.dtype, shape=da.shape)
+    for i in range(0, da.shape[0], batch_size):
+        out[i:i + batch_size] = da[i:i + batch_size].values
+    out.flush()
+    del out
+    return np.load(path, mmap_mode='r')
+
+
+def _npy_cache_path(da, source, name, dtype=None):
+    """
+    Get the path of a .npy cache file next to the source file of a DataArray. The file name contains a hash of the
+    coordinates, shape and type of the DataArray and the modification time of the source, so that a different selection
+    of data or a change to the source file produces a new file.
+
+    :param da: xarray DataArray: data to cache
+    :param source: str: path to the file from which the data are read
+    :param name: str: name added to the file name
+    :param dtype: numpy dtype or None: type of the data in the file; defaults to that of da
+    :return: str: path
+    """
+    key = hashlib.md5(repr((da.dims, da.shape, str(dtype or da.dtype), os.path.getmtime(source))).encode())
+    for coord in sorted(da.coords):
+        key.update(str(coord).encode())
+        key.update(np.asarray(da[coord].values).astype(str).tobytes())
+    return '%s.%s.%s.npy' % (source, key.hexdigest()[:16], name)
+
+
+# The kernels are serial: the gather is memory-bound, prefetch threads already provide the parallelism, and numba's
+# parallel threading layers may hang at exit when parallel kernels are launched from threads other than the main one
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _gather_scale_kernel(array, indices, mean, inverse_scale, out):
+        for i in range(indices.shape[0]):
+            for j in range(indices.shape[1]):
+                k = indices[i, j]
+                for c in range(array.shape[1]):
+                    for f in range(array.shape[2]):
+                        out[i, j, c, f] = (array[k, c, f] - mean[j, c, f]) * inverse_scale[j, c, f]
+
+    # numba does not support float16, so float16 data are read as their uint16 bits and converted with a table
+    @njit(fastmath=True, cache=True)
+    def _gather_scale_half_kernel(array, table, indices, mean, inverse_scale, out):
+        for i in range(indices.shape[0]):
+            for j in range(indices.shape[1]):
+                k = indices[i, j]
+                for c in range(array.shape[1]):
+                    for f in range(array.shape[2]):
+                        out[i, j, c, f] = (table[array[k, c, f]] - mean[j, c, f]) * inverse_scale[j, c, f]
+
+    _half_table = np.arange(2 ** 16, dtype=np.uint16).view(np.float16).astype(np.float32)
+else:
+    _gather_scale_kernel = None
+    _gather_scale_half_kernel = None
+
+
+def _gather_scale(array, indices, out, mean=None, inverse_scale=None):
+    """
+    Gather time steps of an array into an output array, optionally applying the transform (x - mean) * inverse_scale
+    in the same pass. If numba is installed, the gather and scaling are done in a single compiled kernel, which also
+    converts float16 data to float32.
+
+    :param array: ndarray: data with time as the first dimension. May be a view, but the data at each time must be
+        contiguous.
+    :param indices: ndarray: 2-d integer array of (sample, time_step) indices into the first dimension of array
+    :param out: ndarray: output array of shape (sample, time_step, channel, [y, x]), where channel includes all
+        non-spatial dimensions of array. May be a view, but its spatial dimensions must be contiguous. May have a
+        larger floating-point type than array. Indices must be within array; they are not checked here, so callers
+        must check them.
+    :param mean: ndarray or None: mean of shape (time_step, channel, [y, x])
+    :param inverse_scale: ndarray or None: reciprocal of the scale, of shape (time_step, channel, [y, x])
+    """
+    shape = out.shape[:3] + (-1,)
+    if _gather_scale_half_kernel is not None and array.dtype == np.float16 and out.dtype == np.float32:
+        if mean is None:
+            mean = np.zeros(out.shape[1:], dtype=np.float32)
+            inverse_scale = np.ones(out.shape[1:], dtype=np.float32)
+        _gather_scale_half_kernel(array.view(np.uint16).reshape((array.shape[0],) + shape[2:]), _half_table, indices,
+                                  mean.reshape(shape[1:]), inverse_scale.reshape(shape[1:]), out.reshape(shape))
+    elif mean is not None and _gather_scale_kernel is not None and array.dtype == out.dtype:
+        _gather_scale_kernel(array.reshape((array.shape[0],) + shape[2:]), indices, mean.reshape(shape[1:]),
+                             inverse_scale.reshape(shape[1:]), out.reshape(shape))
+    else:
+        if array.dtype == out.dtype and array.flags.c_contiguous and out.flags.c_contiguous:
+            # Callers check the indices, for example SeriesDataGenerator.generate() checks the samples, so clipping
+            # never applies. mode='clip' is used only because np.take then writes directly to out; with the default
+            # mode='raise', it writes to a temporary array and copies that to out.
+            np.take(array, indices, axis=0, out=out, mode='clip')
+        else:
+            # np.take also uses a temporary array for a non-contiguous out, such as the data channels of predictors
+            # that include insolation, copies the whole of a non-contiguous array, such as a view of some of the
+            # variables, and does not convert data stored in a smaller type. Copy (and convert) each time step of
+            # each sample directly instead.
+            for i, j in np.ndindex(indices.shape):
+                out[i, j] = array[indices[i, j]]
+        if mean is not None:
+            out -= mean
+            out *= inverse_scale
+
 
 class DataGenerator(Sequence):
     """
@@ -46,6 +212,10 @@ class DataGenerator(Sequence):
         self._indices = []
         self._n_sample = ds.dims['sample']
         self._has_time_step = 'time_step' in ds.dims
+        self._predictors_np = None
+        self._targets_np = None
+        self._conv_shape = self.convolution_shape
+        self._dense_shape = self.dense_shape
 
         self.on_epoch_end()
 
@@ -77,29 +247,30 @@ class DataGenerator(Sequence):
         else:
             return (self.n_features,) + ()
 
+    def _compute_convolution_shape(self, keep_time_axis):
+        """
+        :param keep_time_axis: bool: if True, include the time step dimension
+        :return: the shape of the predictors expected by a convolutional layer
+        """
+        if keep_time_axis:
+            return (self.shape[0],) + (int(np.prod(self.shape[1:-2])),) + self.shape[-2:]
+        else:
+            return (int(np.prod(self.shape[:-2])),) + self.ds.predictors.shape[-2:]
+
     @property
     def convolution_shape(self):
         """
         :return: the shape of the predictors expected by a Conv2D or ConvLSTM2D layer. If the model is recurrent,
             (time_step, channels, y, x); if not, (channels, y, x).
         """
-        if self._keep_time_axis:
-            return (self.shape[0],) + (int(np.prod(self.shape[1:-2])),) + self.shape[-2:]
-        else:
-            return (int(np.prod(self.shape[:-2])),) + self.ds.predictors.shape[-2:]
+        return self._compute_convolution_shape(self._keep_time_axis)
 
     @property
     def shape_2d(self):
         """
         :return: the shape of the predictors expected by a Conv2D layer, (channels, y, x)
         """
-        if self._keep_time_axis:
-            self._keep_time_axis = False
-            s = tuple(self.convolution_shape)
-            self._keep_time_axis = True
-            return s
-        else:
-            return self.convolution_shape
+        return self._compute_convolution_shape(False)
 
     def on_epoch_end(self):
         self._indices = np.arange(self._n_sample)
@@ -107,15 +278,20 @@ class DataGenerator(Sequence):
             np.random.shuffle(self._indices)
 
     def generate(self, samples, scale_and_impute=True):
+        # Read the arrays once and index them with numpy rather than selecting from the Dataset for every batch
+        if self._predictors_np is None:
+            self._predictors_np = self.ds.predictors.values
+            self._targets_np = self.ds.targets.values
         if len(samples) > 0:
-            ds = self.ds.isel(sample=samples)
+            samples = np.asarray(samples, dtype=np.int64)
+            p = np.take(self._predictors_np, samples, axis=0)
+            t = np.take(self._targets_np, samples, axis=0)
         else:
-            ds = self.ds.isel(sample=slice(None))
-        n_sample = ds.predictors.shape[0]
-        p = ds.predictors.values.reshape((n_sample, -1))
-        t = ds.targets.values.reshape((n_sample, -1))
-        ds.close()
-        ds = None
+            p = self._predictors_np.copy()
+            t = self._targets_np.copy()
+        n_sample = p.shape[0]
+        p = p.reshape((n_sample, -1))
+        t = t.reshape((n_sample, -1))
 
         # Remove samples with NaN; scale and impute
         if self._remove_nan:
@@ -127,11 +303,11 @@ class DataGenerator(Sequence):
 
         # Format spatial shape for convolutions; also takes care of time axis
         if self._is_convolutional:
-            p = p.reshape((n_sample,) + self.convolution_shape)
-            t = t.reshape((n_sample,) + self.convolution_shape)
+            p = p.reshape((n_sample,) + self._conv_shape)
+            t = t.reshape((n_sample,) + self._conv_shape)
         elif self._keep_time_axis:
-            p = p.reshape((n_sample,) + self.dense_shape)
-            t = t.reshape((n_sample,) + self.dense_shape)
+            p = p.reshape((n_sample,) + self._dense_shape)
+            t = t.reshape((n_sample,) + self._dense_shape)
 
         return p, t
 
@@ -173,7 +349,8 @@ class SeriesDataGenerator(Sequence):
 
     def __init__(self, model, ds, rank=2, input_sel=None, output_sel=None, input_time_steps=1, output_time_steps=1,
                  sequence=None, interval=1, add_insolation=False, batch_size=32, shuffle=False, remove_nan=True,
-                 load='required', delay_load=False, constants=None, channels_last=False, drop_remainder=False):
+                 load='required', delay_load=False, constants=None, channels_last=False, drop_remainder=False,
+                 preallocate=False, cache_bytes=0, prefetch=0, dtype=None):
         """
         Initialize a SeriesDataGenerator.
 
@@ -199,21 +376,45 @@ class SeriesDataGenerator(Sequence):
         :param batch_size: int: number of samples to take at a time from the dataset
         :param shuffle: bool: if True, randomly select batches
         :param remove_nan: bool: if True, remove any samples with NaNs
-        :param load: str: option for loading data into memory. If it evaluates to negative, no memory loading is done.
-            THIS IS LIKELY VERY SLOW.
+        :param load: str: option for loading data into memory. If it evaluates to negative, no memory loading is done;
+            only the time steps used by each batch are read from the Dataset. This keeps memory use small, but is
+            likely slow; 'mmap' is usually much faster for data that do not fit in memory.
             'full': load the full dataset. May use a lot of memory.
             'required': load only the required variables, but this also loads two separate datasets for predictors and
                 targets
             'minimal': load only one copy of the data, but also loads all of the variables. This may use half as much
                 memory as 'required', but only if there are no unused extra variables in the file. Note that in order
                 to attempt to use numpy views to save memory, the order of variables may be different from the
-                input and output selections.
+                input and output selections. If there are extra variables in both the input and output selections,
+                they are copied as with 'required', in addition to the loaded data.
+            'mmap': write the required variables to .npy files and memory-map them. Only the parts of the files used
+                by batches are read into memory, by the operating system, which is useful when the data do not fit in
+                memory. The files are kept next to the source file of the Dataset and re-used when the same data are
+                selected again; if that is not possible, temporary files are used.
         :param delay_load: if True, delay the loading of the data until the first call to generate()
         :param constants: ndarray: additional constant fields to add to each input. Must match the spatial dimensions
             (last `rank` dimensions) of the input data.
         :param channels_last: bool: if True, returns data with channels as the last dimension. May slow down processing
             of data, but may speed up GPU operations on the data.
         :param drop_remainder: bool: if True, ignore the last batch of data if it is smaller than the batch size
+        :param preallocate: bool: if True, allocate the arrays for a batch only once and re-use them for every batch,
+            which avoids allocating and initializing new memory for each batch. Arrays returned by a previous call to
+            generate() are then overwritten, so this is only safe if each batch is consumed before the next one is
+            generated, for example with tf_data_generator(). It is not safe with Keras fit() using workers, which
+            queues several batches.
+        :param cache_bytes: int: if shuffle is False, keep up to this many bytes of generated batches in memory and
+            return them again in later epochs. The least recently used batches are discarded first. Useful for
+            validation data that are iterated many times. Not compatible with preallocate.
+        :param prefetch: int: if > 0, generate up to this many of the following batches in background threads while
+            the current batch is being used. Not compatible with preallocate. Once batches have been generated, the
+            generator holds a thread pool and can not be pickled, so it can not be used with Keras'
+            use_multiprocessing=True.
+        :param dtype: numpy dtype or None: if given, store the input and output data in memory (or in memory-mapped
+            files) with this type, for example 'float16' to halve memory use. Batches are still returned as at least
+            float32. Only use a reduced precision for data that are already normalized, for example by the
+            scale_variables option of the Preprocessor. With numba installed, float16 data are converted while being
+            gathered, at about the speed of gathering and scaling float32 data; without numba, the conversion makes
+            generating batches slower.
         """
         self.model = model
         if not hasattr(ds, 'predictors'):
@@ -225,12 +426,18 @@ class SeriesDataGenerator(Sequence):
         assert int(interval) > 0
         if sequence is not None:
             assert int(sequence) > 0
+        assert int(cache_bytes) >= 0
+        assert int(prefetch) >= 0
+        if to_bool(preallocate) and int(cache_bytes) > 0:
+            raise ValueError("'preallocate' and 'cache_bytes' can not be used together")
+        if to_bool(preallocate) and int(prefetch) > 0:
+            raise ValueError("'preallocate' and 'prefetch' can not be used together")
         if not(not load):
-            if load not in ['full', 'required', 'minimal']:
+            if load not in ['full', 'required', 'minimal', 'mmap']:
                 if isinstance(load, bool):
                     load = 'required'
                 else:
-                    raise ValueError("'load' must be one of 'full', 'required', or 'minimal'")
+                    raise ValueError("'load' must be one of 'full', 'required', 'minimal', or 'mmap'")
         try:
             add_insolation = to_bool(add_insolation)
         except ValueError:
@@ -242,6 +449,20 @@ class SeriesDataGenerator(Sequence):
         self._daily_insolation = str(add_insolation) == 'daily'
         self._load = load
         self._is_loaded = False
+        self._mmap_dir = None
+        self._dtype = np.dtype(dtype) if dtype is not None else None
+        self._scaler_cache = None
+        self._nan_samples = None
+        self._preallocate = to_bool(preallocate)
+        self._buffers = {}
+        self._cache_bytes = int(cache_bytes)
+        self._batch_cache = OrderedDict()
+        self._batch_cache_nbytes = 0
+        self._batch_cache_scalers = None
+        self._prefetch = int(prefetch)
+        self._executor = None
+        self._futures = {}
+        self._futures_lock = threading.Lock()
 
         self.ds = ds
         self._batch_size = batch_size
@@ -295,6 +516,8 @@ class SeriesDataGenerator(Sequence):
                              daily=self._daily_insolation)
             self.insolation_da = xr.DataArray(sol, dims=['sample'] + ['x%d' % r for r in range(self.rank)])
             self.insolation_da['sample'] = self.da.sample.values
+            # Insolation with a channel dimension, (time, 1, [y, x]), gathered like the input data
+            self._insolation_np = self.insolation_da.values[:, np.newaxis]
 
         # Add extra constants
         self.constants = constants
@@ -307,6 +530,11 @@ class SeriesDataGenerator(Sequence):
 
         # Transpose option
         self.channels_last = to_bool(channels_last)
+        # Shapes of the channels-first data in generate(), computed once rather than for every batch
+        self._conv_shape = self._compute_convolution_shape(self._keep_time_axis, False)
+        self._output_conv_shape = self._compute_output_convolution_shape(self._keep_time_axis, False)
+        self._dense_shape = self.dense_shape
+        self._output_dense_shape = self.output_dense_shape
         self._time_transpose = (0, 1,) + tuple(range(3, 3 + self.rank)) + (2,)
         if self._keep_time_axis:
             self._transpose = self._time_transpose
@@ -314,7 +542,9 @@ class SeriesDataGenerator(Sequence):
             self._transpose = (0,) + tuple(range(2, 2 + self.rank)) + (1,)
 
     def _load_data(self):
-        if not(not self._load):
+        if self._load == 'mmap':
+            print('SeriesDataGenerator: writing data to memory-mapped files')
+        elif not(not self._load):
             print('SeriesDataGenerator: loading data to memory')
         if self._load == 'full':
             self.ds.load()
@@ -333,6 +563,8 @@ class SeriesDataGenerator(Sequence):
                 else:
                     self.da = self.da.sel(varlev=union + added_in + added_out)
                     self.da.load()
+                    # With each time step contiguous, the input and output are views of blocks of each time step
+                    self.da = _contiguous_time_steps(self.da, self._dtype)
                     self.input_da = self.da.isel(varlev=slice(0, len(union) + len(added_in)))
                     self.output_da = self.da.isel(varlev=slice(0, len(union) + len(added_out)))
             else:
@@ -344,8 +576,73 @@ class SeriesDataGenerator(Sequence):
             if self._load == 'required':
                 self.input_da.load()
                 self.output_da.load()
+        if not self._load:
+            # Data which are not loaded are read for each batch in generate(), and NaN are removed there
+            self._input_np = None
+            self._output_np = None
+            self._nan_samples = None
+            self._is_loaded = True
+            return
+        # Cache the underlying arrays of the loaded data so that batches are gathered with numpy rather than xarray
+        # indexing. Each time step must be a single contiguous block: selecting a list of variables with sel() returns
+        # an array ordered by variable rather than by time, which would make every gather read across the whole array.
+        # Such arrays are copied once here, and the DataArrays are replaced by the copies so that the originals can be
+        # released. The views of 'minimal' loading are already stored this way.
+        if self._load == 'mmap':
+            self._input_np = self._memory_map(self.input_da, 'input')
+            self._output_np = self._memory_map(self.output_da, 'output')
+        else:
+            self.input_da = _contiguous_time_steps(self.input_da, self._dtype)
+            self.output_da = _contiguous_time_steps(self.output_da, self._dtype)
+            self._input_np = self.input_da.values
+            self._output_np = self.output_da.values
+        # Merge all non-spatial dimensions into one channel dimension, (time, channel, [y, x]); a view, since each
+        # time step is contiguous
+        self._input_np = self._input_np.reshape(self._input_np.shape[:1] + (-1,) + self._input_np.shape[-self.rank:])
+        self._output_np = self._output_np.reshape(self._output_np.shape[:1] + (-1,)
+                                                  + self._output_np.shape[-self.rank:])
+
+        # Find samples with NaN in any input or target time step once, rather than checking every batch
+        self._nan_samples = None
+        if self._remove_nan:
+            input_nan = _any_nan(self._input_np)
+            output_nan = _any_nan(self._output_np)
+            nan_samples = np.zeros(self._n_sample, dtype=bool)
+            for n in range(self._input_time_steps):
+                nan_samples |= input_nan[self._interval * n:self._interval * n + self._n_sample]
+            for n in range(self._output_time_steps * (self._sequence or 1)):
+                offset = self._interval * (self._input_time_steps + n)
+                nan_samples |= output_nan[offset:offset + self._n_sample]
+            if np.any(nan_samples):
+                self._nan_samples = nan_samples
         self._is_loaded = True
 
+    def _memory_map(self, da, name):
+        """
+        Get a read-only memory-map of the data in a DataArray, re-using a .npy file next to the source file of the
+        Dataset if one exists for the same data, or writing it otherwise.
+
+        :param da: xarray DataArray: data to map
+        :param name: str: name of the file
+        :return: numpy memmap
+        """
+        source = self.ds.encoding.get('source', None)
+        if source is not None and os.path.isfile(source):
+            path = _npy_cache_path(da, source, name, self._dtype)
+            temp_path = '%s.%d.tmp' % (path, os.getpid())
+            try:
+                if not os.path.isfile(path):
+                    _to_npy(da, temp_path, self._dtype)
+                    os.replace(temp_path, path)
+                return np.load(path, mmap_mode='r')
+            except OSError as e:
+                warnings.warn("could not use cached data file '%s' (%s); using a temporary file" % (path, e))
+                if os.path.isfile(temp_path):
+                    os.remove(temp_path)
+        if self._mmap_dir is None:
+            self._mmap_dir = tempfile.TemporaryDirectory(prefix='dlwp-')
+        return _to_npy(da, os.path.join(self._mmap_dir.name, name + '.npy'), self._dtype)
+
     @property
     def shape(self):
         """
@@ -372,39 +669,47 @@ class SeriesDataGenerator(Sequence):
         else:
             return (self.n_features,) + ()
 
-    @property
-    def convolution_shape(self):
+    def _channels_last_shape(self, shape, keep_time_axis):
         """
-        :return: the shape of the predictors expected by a Conv2D or ConvLSTM2D layer. If the model is recurrent,
-            (time_step, channels, y, x); if not, (channels, y, x). Includes insolation.
+        :param shape: tuple: channels-first shape, (time_step, channels, y, x) or (channels, y, x)
+        :param keep_time_axis: bool: if True, shape includes the time step dimension
+        :return: tuple: shape with the channels dimension moved to the end
         """
-        if self._keep_time_axis:
+        if keep_time_axis:
+            return (shape[0],) + tuple(shape[2:]) + (shape[1],)
+        else:
+            return tuple(shape[1:]) + (shape[0],)
+
+    def _compute_convolution_shape(self, keep_time_axis, channels_last):
+        """
+        :param keep_time_axis: bool: if True, include the time step dimension
+        :param channels_last: bool: if True, put the channels dimension last
+        :return: the shape of the predictors expected by a convolutional layer; includes insolation
+        """
+        if keep_time_axis:
             result = (self._input_time_steps,) + (int(np.prod(self.shape[1:-self.rank])) + self._add_insolation,)\
                 + self.shape[-self.rank:]
-            if self.channels_last:
-                return tuple([result[s - 1] for s in self._time_transpose[1:]])
-            else:
-                return result
         else:
             result = (int(np.prod(self.shape[:-self.rank])) +
                       self._input_time_steps * self._add_insolation,) + self.shape[-self.rank:]
-            if self.channels_last:
-                return tuple([result[s-1] for s in self._transpose[1:]])
-            else:
-                return result
+        if channels_last:
+            return self._channels_last_shape(result, keep_time_axis)
+        return result
+
+    @property
+    def convolution_shape(self):
+        """
+        :return: the shape of the predictors expected by a Conv2D or ConvLSTM2D layer. If the model is recurrent,
+            (time_step, channels, y, x); if not, (channels, y, x). Includes insolation.
+        """
+        return self._compute_convolution_shape(self._keep_time_axis, self.channels_last)
 
     @property
     def shape_2d(self):
         """
         :return: the shape of the predictors expected by a Conv2D layer, (channels, y, x); includes insolation
         """
-        if self._keep_time_axis:
-            self._keep_time_axis = False
-            s = tuple(self.convolution_shape)
-            self._keep_time_axis = True
-            return s
-        else:
-            return self.convolution_shape
+        return self._compute_convolution_shape(False, self.channels_last)
 
     @property
     def output_shape(self):
@@ -431,38 +736,35 @@ class SeriesDataGenerator(Sequence):
         else:
             return (self.output_n_features,) + ()
 
-    @property
-    def output_convolution_shape(self):
+    def _compute_output_convolution_shape(self, keep_time_axis, channels_last):
         """
-        :return: the shape of the predictors expected to be returned by a Conv2D or ConvLSTM2D layer. If the model is
-            recurrent, (time_step, channels, y, x); if not, (channels, y, x).
+        :param keep_time_axis: bool: if True, include the time step dimension
+        :param channels_last: bool: if True, put the channels dimension last
+        :return: the shape of the predictors expected to be returned by a convolutional layer
         """
-        if self._keep_time_axis:
+        if keep_time_axis:
             result = (self._output_time_steps,) + (int(np.prod(self.output_shape[1:-self.rank])),) \
                 + self.output_shape[-self.rank:]
-            if self.channels_last:
-                return tuple([result[s-1] for s in self._time_transpose[1:]])
-            else:
-                return result
         else:
             result = (int(np.prod(self.output_shape[:-self.rank])),) + self.shape[-self.rank:]
-            if self.channels_last:
-                return tuple([result[s-1] for s in self._transpose[1:]])
-            else:
-                return result
+        if channels_last:
+            return self._channels_last_shape(result, keep_time_axis)
+        return result
+
+    @property
+    def output_convolution_shape(self):
+        """
+        :return: the shape of the predictors expected to be returned by a Conv2D or ConvLSTM2D layer. If the model is
+            recurrent, (time_step, channels, y, x); if not, (channels, y, x).
+        """
+        return self._compute_output_convolution_shape(self._keep_time_axis, self.channels_last)
 
     @property
     def output_shape_2d(self):
         """
         :return: the shape of the predictors expected to be returned by a Conv2D layer, (channels, y, x)
         """
-        if self._keep_time_axis:
-            self._keep_time_axis = False
-            s = tuple(self.output_convolution_shape)
-            self._keep_time_axis = True
-            return s
-        else:
-            return self.output_convolution_shape
+        return self._compute_output_convolution_shape(False, self.channels_last)
 
     @property
     def insolation_shape(self):
@@ -479,103 +781,175 @@ class SeriesDataGenerator(Sequence):
         self._indices = np.arange(self._n_sample)
         if self._shuffle:
             np.random.shuffle(self._indices)
+        # Batches prefetched with the old indices are no longer valid
+        with self._futures_lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures = {}
+
+    def _scaler_parameters(self):
+        """
+        Get the parameters of the model's scaler so that scaling can be done while gathering the data.
+
+        :return: (mean, inverse_scale, output_mean, output_inverse_scale) with shapes (time_step, channel, [y, x]),
+            where any may be None if no scaling is applied, or None if the model's scaler cannot be applied as a simple
+            affine transform
+        """
+        if getattr(self.model, 'scaler_type', None) is None:
+            return None, None, None, None
+        scalers = [self.model.scaler, self.model.scaler_y if self.model.scale_targets else None]
+        if self.model.scaler is None or not all(hasattr(scaler, 'mean_') for scaler in scalers if scaler is not None):
+            return None
+        if self._scaler_cache is None or any(a is not b for a, b in zip(self._scaler_cache[0], scalers)):
+            spatial_shape = self.input_da.shape[-self.rank:]
+            n_channel = int(np.prod(self.input_da.shape[1:-self.rank]))
+            n_output_channel = int(np.prod(self.output_da.shape[1:-self.rank]))
+            shapes = [(self._input_time_steps, n_channel + self._add_insolation) + spatial_shape,
+                      (self._output_time_steps, n_output_channel) + spatial_shape]
+            params = []
+            for scaler, shape in zip(scalers, shapes):
+                if scaler is None:
+                    params.extend([None, None])
+                    continue
+                mean = np.zeros(shape, dtype=np.float32)
+                inverse_scale = np.ones(shape, dtype=np.float32)
+                if scaler.with_mean:
+                    mean[:] = scaler.mean_.reshape(shape)
+                if scaler.with_std:
+                    inverse_scale[:] = 1. / scaler.scale_.reshape(shape)
+                params.extend([mean, inverse_scale])
+            self._scaler_cache = (scalers, tuple(params))
+        return self._scaler_cache[1]
+
+    def _read_time_steps(self, da, indices):
+        """
+        Read only the time steps of a DataArray which are used by a batch, for data which are not loaded.
+
+        :param da: xarray DataArray: data with time as the first dimension
+        :param indices: ndarray: integer indices into the first dimension of da
+        :return: (ndarray, ndarray): data of the used time steps, of shape (time, channel, [y, x]), and indices into
+            its first dimension, of the same shape as indices
+        """
+        steps, inverse = np.unique(indices, return_inverse=True)
+        array = np.ascontiguousarray(da.isel(sample=steps).values, dtype=self._dtype)
+        return array.reshape(array.shape[:1] + (-1,) + array.shape[-self.rank:]), inverse.reshape(indices.shape)
+
+    def _empty(self, key, shape, dtype):
+        """
+        Get an uninitialized array for a batch of data. If preallocate is True and the array is no larger than a batch,
+        the array is a view of a buffer that is re-used on every call.
+
+        :param key: hashable: name of the buffer
+        :param shape: tuple: shape of the array
+        :param dtype: dtype of the array
+        :return: ndarray
+        """
+        if not self._preallocate or shape[0] > self._batch_size:
+            return np.empty(shape, dtype=dtype)
+        buffer = self._buffers.get(key, None)
+        if buffer is None or buffer.shape[1:] != shape[1:] or buffer.dtype != dtype:
+            buffer = np.empty((self._batch_size,) + shape[1:], dtype=dtype)
+            self._buffers[key] = buffer
+        return buffer[:shape[0]]
 
     def generate(self, samples, scale_and_impute=True):
         if len(samples) == 0:
-            samples = np.arange(self._n_sample, dtype=np.int)
+            samples = np.arange(self._n_sample, dtype=np.int64)
         else:
-            samples = np.array(samples, dtype=np.int)
-        n_sample = len(samples)
+            samples = np.asarray(samples, dtype=np.int64)
+            # Data are gathered without bounds checks
+            if samples.min() < 0 or samples.max() >= self._n_sample:
+                raise IndexError('samples must be in the range 0 to %d' % (self._n_sample - 1))
 
         if not self._is_loaded:
             self._load_data()
 
-        # Predictors
-        p = np.concatenate([self.input_da.values[samples + n * self._interval, np.newaxis]
-                            for n in range(self._input_time_steps)], axis=1)
+        # Remove samples with NaN
+        if self._nan_samples is not None:
+            samples = samples[~self._nan_samples[samples]]
+
+        # Time steps of the predictors and of the targets of all steps of a sequence, as (sample, time_step) indices
+        input_steps = self._interval * np.arange(self._input_time_steps)
+        input_indices = samples[:, np.newaxis] + input_steps
+        output_indices = samples[:, np.newaxis] + self._interval * (
+                self._input_time_steps + np.arange(self._output_time_steps * (self._sequence or 1)))
+        if self._input_np is None:
+            # Data which are not loaded are read only for the time steps of this batch
+            input_np, input_indices = self._read_time_steps(self.input_da, input_indices)
+            output_np, output_indices = self._read_time_steps(self.output_da, output_indices)
+            if self._remove_nan:
+                keep = ~(_any_nan(input_np)[input_indices].any(axis=1)
+                         | _any_nan(output_np)[output_indices].any(axis=1))
+                samples, input_indices, output_indices = samples[keep], input_indices[keep], output_indices[keep]
+        else:
+            input_np, output_np = self._input_np, self._output_np
+        n_sample = len(samples)
+
+        # Scaling is applied while gathering data, unless the model's imputer or scaler must be called
+        scaling = self._scaler_parameters() if scale_and_impute and not self._impute_missing else None
+        fused = scaling is not None
+        p_mean, p_inverse_scale, t_mean, t_inverse_scale = scaling or (None,) * 4
+        spatial_shape = input_np.shape[2:]
+        n_channel = input_np.shape[1]
+        n_output_channel = output_np.shape[1]
+        # Data stored with reduced precision are returned as float32
+        input_dtype = np.promote_types(input_np.dtype, np.float32)
+        output_dtype = np.promote_types(output_np.dtype, np.float32)
+
+        # Predictors; gather all time steps at once with a 2-d (sample, time_step) index
+        p = self._empty('predictors', (n_sample, self._input_time_steps, n_channel + self._add_insolation)
+                        + spatial_shape, input_dtype)
+        _gather_scale(input_np, input_indices, p[:, :, :n_channel],
+                      None if p_mean is None else p_mean[:, :n_channel],
+                      None if p_inverse_scale is None else p_inverse_scale[:, :n_channel])
         if self._add_insolation:
+            # Insolation for the first step of a sequence is gathered directly into the predictors; subsequent steps
+            # are separate inputs
+            _gather_scale(self._insolation_np, samples[:, np.newaxis] + input_steps, p[:, :, n_channel:],
+                          None if p_mean is None else p_mean[:, n_channel:],
+                          None if p_inverse_scale is None else p_inverse_scale[:, n_channel:])
             insol = []
-            if self._sequence is not None:
-                for s in range(self._sequence):
-                    insol.append(
-                        np.concatenate(
-                            [self.insolation_da.values[samples + self._interval * (self._input_time_steps * s + n),
-                                                       np.newaxis, np.newaxis] for n in range(self._input_time_steps)],
-                            axis=1
-                        )
-                    )
-            else:
-                insol.append(
-                    np.concatenate([self.insolation_da.values[samples + n * self._interval, np.newaxis, np.newaxis]
-                                    for n in range(self._input_time_steps)], axis=1)
-                )
-            p = np.concatenate([p, insol[0]], axis=2)
-        p = p.reshape((n_sample, -1))
+            for s in range(1, self._sequence or 1):
+                i = self._empty(('insolation', s), (n_sample, self._input_time_steps, 1) + spatial_shape,
+                                self._insolation_np.dtype)
+                # Samples were checked above, so mode='clip' only avoids np.take's temporary copy of out
+                np.take(self._insolation_np, samples[:, np.newaxis] + input_steps
+                        + self._interval * self._input_time_steps * s, axis=0, out=i, mode='clip')
+                insol.append(i)
 
         # Targets, including sequence if desired
-        if self._sequence is not None:
-            targets = []
-            for s in range(self._sequence):
-                t = np.concatenate(
-                    [self.output_da.values[samples + self._interval * (
-                            self._input_time_steps + self._output_time_steps * s + n), np.newaxis]
-                     for n in range(self._output_time_steps)],
-                    axis=1
-                )
-
-                t = t.reshape((n_sample, -1))
-
-                # Remove samples with NaN; scale and impute
-                if self._remove_nan:
-                    p, t = delete_nan_samples(p, t)
-                if scale_and_impute:
-                    if self._impute_missing:
-                        p, t = self.model.imputer_transform(p, t)
-                    p, t = self.model.scaler_transform(p, t)
-
-                # Format spatial shape for convolutions; also takes care of time axis
-                if self._is_convolutional:
-                    cl = bool(self.channels_last)
-                    self.channels_last = False
-                    p = p.reshape((n_sample,) + self.convolution_shape)
-                    t = t.reshape((n_sample,) + self.output_convolution_shape)
-                    self.channels_last = bool(cl)
-                elif self._keep_time_axis:
-                    p = p.reshape((n_sample,) + self.dense_shape)
-                    t = t.reshape((n_sample,) + self.output_dense_shape)
+        targets = []
+        for s in range(self._sequence or 1):
+            t = self._empty(('targets', s), (n_sample, self._output_time_steps, n_output_channel) + spatial_shape,
+                            output_dtype)
+            _gather_scale(output_np, output_indices[:, self._output_time_steps * s:self._output_time_steps * (s + 1)],
+                          t, t_mean, t_inverse_scale)
+            targets.append(t)
+
+        # Scale and impute the predictors once, and the targets of all steps of a sequence together
+        if scale_and_impute and not fused:
+            t = np.concatenate(targets) if len(targets) > 1 else targets[0]
+            if self._impute_missing:
+                p, t = self.model.imputer_transform(p, t)
+            p, t = self.model.scaler_transform(p, t)
+            targets = np.split(t, len(targets))
 
-                targets.append(t)
+        # Format spatial shape for convolutions; also takes care of time axis
+        if self._is_convolutional:
+            p_shape, t_shape = self._conv_shape, self._output_conv_shape
+        elif self._keep_time_axis:
+            p_shape, t_shape = self._dense_shape, self._output_dense_shape
+        else:
+            p_shape, t_shape = (-1,), (-1,)
+        p = p.reshape((n_sample,) + p_shape)
+        targets = [t.reshape((n_sample,) + t_shape) for t in targets]
 
+        if self._sequence is not None:
             # Sequence of inputs (plus insolation) for predictors
             if self._add_insolation:
-                p = [p] + insol[1:]
+                p = [p] + insol
         else:
-            t = np.concatenate([self.output_da.values[samples + self._interval * (self._input_time_steps + n),
-                                                      np.newaxis]
-                                for n in range(self._output_time_steps)], axis=1)
-
-            t = t.reshape((n_sample, -1))
-
-            # Remove samples with NaN; scale and impute
-            if self._remove_nan:
-                p, t = delete_nan_samples(p, t)
-            if scale_and_impute:
-                if self._impute_missing:
-                    p, t = self.model.imputer_transform(p, t)
-                p, t = self.model.scaler_transform(p, t)
-
-            # Format spatial shape for convolutions; also takes care of time axis
-            if self._is_convolutional:
-                cl = bool(self.channels_last)
-                self.channels_last = False
-                p = p.reshape((n_sample,) + self.convolution_shape)
-                t = t.reshape((n_sample,) + self.output_convolution_shape)
-                self.channels_last = bool(cl)
-            elif self._keep_time_axis:
-                p = p.reshape((n_sample,) + self.dense_shape)
-                t = t.reshape((n_sample,) + self.output_dense_shape)
-
-            targets = t
+            targets = targets[0]
 
         # Add constants
         if self.constants is not None:
@@ -623,15 +997,80 @@ class SeriesDataGenerator(Sequence):
         # Generate indexes of the batch
         if int(index) < 0:
             index = len(self) + index
-        if index > len(self):
+        if index >= len(self):
             raise IndexError
         indexes = self._indices[index * self._batch_size:(index + 1) * self._batch_size]
 
-        # Generate data
-        X, y = self.generate(indexes)
+        # Batches are the same in every epoch without shuffling, so they may be cached
+        use_cache = self._cache_bytes > 0 and not self._shuffle
+        if use_cache:
+            # Cached batches are invalid if the model's scaling has changed
+            scalers = (getattr(self.model, 'scaler', None), getattr(self.model, 'scaler_y', None))
+            if self._batch_cache_scalers is None or any(a is not b for a, b in zip(self._batch_cache_scalers,
+                                                                                   scalers)):
+                self._batch_cache.clear()
+                self._batch_cache_nbytes = 0
+                self._batch_cache_scalers = scalers
+            if index in self._batch_cache:
+                self._batch_cache.move_to_end(index)
+                return self._batch_cache[index]
+
+        # Generate data, submitting the following batches to the background threads
+        if self._prefetch > 0:
+            if not self._is_loaded:
+                self._load_data()
+            # Keras may call __getitem__ from several threads, so the futures are only changed under the lock
+            with self._futures_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._prefetch)
+                for i in range(index, min(index + self._prefetch + 1, len(self))):
+                    if i not in self._futures and not (use_cache and i in self._batch_cache):
+                        self._futures[i] = self._executor.submit(
+                            self.generate, self._indices[i * self._batch_size:(i + 1) * self._batch_size])
+                future = self._futures.pop(index, None)
+            # Another thread may have taken the future for this batch
+            X, y = future.result() if future is not None else self.generate(indexes)
+        else:
+            X, y = self.generate(indexes)
+
+        if use_cache:
+            self._cache_batch(index, (X, y))
 
         return X, y
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_futures_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._futures_lock = threading.Lock()
+
+    def __del__(self):
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown(wait=False)
+
+    def _cache_batch(self, index, batch):
+        """
+        Add a batch to the cache of generated batches, discarding the least recently used batches to stay within the
+        cache size.
+
+        :param index: int: index of batch
+        :param batch: (ndarray or list, ndarray or list): predictors, targets
+        """
+        def nbytes(b):
+            return sum(a.nbytes for data in b for a in (data if isinstance(data, list) else [data]))
+
+        n_bytes = nbytes(batch)
+        if n_bytes > self._cache_bytes:
+            return
+        while self._batch_cache_nbytes + n_bytes > self._cache_bytes:
+            _, old_batch = self._batch_cache.popitem(last=False)
+            self._batch_cache_nbytes -= nbytes(old_batch)
+        self._batch_cache[index] = batch
+        self._batch_cache_nbytes += n_bytes
+
 
 class ArrayDataGenerator(Sequence):
     """
@@ -729,12 +1168,34 @@ class ArrayDataGenerator(Sequence):
 
         # Transpose option
         self.channels_last = to_bool(channels_last)
+        # Shapes of the channels-first data in generate(), computed once rather than for every batch
+        self._conv_shape = self._compute_convolution_shape(self._keep_time_axis, False)
+        self._output_conv_shape = self._compute_output_convolution_shape(self._keep_time_axis, False)
+        self._dense_shape = self.dense_shape
+        self._output_dense_shape = self.output_dense_shape
         self._time_transpose = (0, 1,) + tuple(range(3, 3 + self.rank)) + (2,)
         if self._keep_time_axis:
             self._transpose = self._time_transpose
         else:
             self._transpose = (0,) + tuple(range(2, 2 + self.rank)) + (1,)
 
+        # Views of the time step windows of in-memory arrays, so that each batch is taken with a single index. Other
+        # array types, such as netCDF4 variables, are indexed one time step at a time.
+        if isinstance(self.array, np.ndarray):
+            channels = np.arange(self.array.shape[1])
+            self._input_channels = channels[self._input_slice]
+            self._output_channels = channels[self._output_slice]
+            self._input_windows = _time_windows(self.array, self._input_time_steps, self._interval)
+            self._output_windows = _time_windows(self.array, self._output_time_steps, self._interval)
+            # If all channels are inputs, they are gathered directly into the batch array rather than through a view
+            self._input_all_channels = self.array.flags.c_contiguous and np.array_equal(self._input_channels, channels)
+        else:
+            self._input_windows = self._output_windows = None
+            self._input_all_channels = False
+        if self._add_insolation:
+            # Insolation with a channel dimension, (time, 1, [y, x])
+            self._insolation_np = np.asarray(self.insolation_array)[:, np.newaxis]
+
     @property
     def shape(self):
         """
@@ -761,39 +1222,47 @@ class ArrayDataGenerator(Sequence):
         else:
             return (self.n_features,) + ()
 
-    @property
-    def convolution_shape(self):
+    def _channels_last_shape(self, shape, keep_time_axis):
         """
-        :return: the shape of the predictors expected by a Conv2D or ConvLSTM2D layer. If the model is recurrent,
-            (time_step, channels, y, x); if not, (channels, y, x). Includes insolation.
+        :param shape: tuple: channels-first shape, (time_step, channels, y, x) or (channels, y, x)
+        :param keep_time_axis: bool: if True, shape includes the time step dimension
+        :return: tuple: shape with the channels dimension moved to the end
         """
-        if self._keep_time_axis:
+        if keep_time_axis:
+            return (shape[0],) + tuple(shape[2:]) + (shape[1],)
+        else:
+            return tuple(shape[1:]) + (shape[0],)
+
+    def _compute_convolution_shape(self, keep_time_axis, channels_last):
+        """
+        :param keep_time_axis: bool: if True, include the time step dimension
+        :param channels_last: bool: if True, put the channels dimension last
+        :return: the shape of the predictors expected by a convolutional layer; includes insolation
+        """
+        if keep_time_axis:
             result = (self._input_time_steps,) + (int(np.prod(self.shape[1:-self.rank])) + self._add_insolation,)\
                 + self.shape[-self.rank:]
-            if self.channels_last:
-                return tuple([result[s - 1] for s in self._time_transpose[1:]])
-            else:
-                return result
         else:
             result = (int(np.prod(self.shape[:-self.rank])) +
                       self._input_time_steps * self._add_insolation,) + self.shape[-self.rank:]
-            if self.channels_last:
-                return tuple([result[s-1] for s in self._transpose[1:]])
-            else:
-                return result
+        if channels_last:
+            return self._channels_last_shape(result, keep_time_axis)
+        return result
+
+    @property
+    def convolution_shape(self):
+        """
+        :return: the shape of the predictors expected by a Conv2D or ConvLSTM2D layer. If the model is recurrent,
+            (time_step, channels, y, x); if not, (channels, y, x). Includes insolation.
+        """
+        return self._compute_convolution_shape(self._keep_time_axis, self.channels_last)
 
     @property
     def shape_2d(self):
         """
         :return: the shape of the predictors expected by a Conv2D layer, (channels, y, x); includes insolation
         """
-        if self._keep_time_axis:
-            self._keep_time_axis = False
-            s = tuple(self.convolution_shape)
-            self._keep_time_axis = True
-            return s
-        else:
-            return self.convolution_shape
+        return self._compute_convolution_shape(False, self.channels_last)
 
     @property
     def output_shape(self):
@@ -820,38 +1289,35 @@ class ArrayDataGenerator(Sequence):
         else:
             return (self.output_n_features,) + ()
 
-    @property
-    def output_convolution_shape(self):
+    def _compute_output_convolution_shape(self, keep_time_axis, channels_last):
         """
-        :return: the shape of the predictors expected to be returned by a Conv2D or ConvLSTM2D layer. If the model is
-            recurrent, (time_step, channels, y, x); if not, (channels, y, x).
+        :param keep_time_axis: bool: if True, include the time step dimension
+        :param channels_last: bool: if True, put the channels dimension last
+        :return: the shape of the predictors expected to be returned by a convolutional layer
         """
-        if self._keep_time_axis:
+        if keep_time_axis:
             result = (self._output_time_steps,) + (int(np.prod(self.output_shape[1:-self.rank])),) \
                 + self.output_shape[-self.rank:]
-            if self.channels_last:
-                return tuple([result[s-1] for s in self._time_transpose[1:]])
-            else:
-                return result
         else:
             result = (int(np.prod(self.output_shape[:-self.rank])),) + self.shape[-self.rank:]
-            if self.channels_last:
-                return tuple([result[s-1] for s in self._transpose[1:]])
-            else:
-                return result
+        if channels_last:
+            return self._channels_last_shape(result, keep_time_axis)
+        return result
+
+    @property
+    def output_convolution_shape(self):
+        """
+        :return: the shape of the predictors expected to be returned by a Conv2D or ConvLSTM2D layer. If the model is
+            recurrent, (time_step, channels, y, x); if not, (channels, y, x).
+        """
+        return self._compute_output_convolution_shape(self._keep_time_axis, self.channels_last)
 
     @property
     def output_shape_2d(self):
         """
         :return: the shape of the predictors expected to be returned by a Conv2D layer, (channels, y, x)
         """
-        if self._keep_time_axis:
-            self._keep_time_axis = False
-            s = tuple(self.output_convolution_shape)
-            self._keep_time_axis = True
-            return s
-        else:
-            return self.output_convolution_shape
+        return self._compute_output_convolution_shape(False, self.channels_last)
 
     @property
     def insolation_shape(self):
@@ -869,45 +1335,62 @@ class ArrayDataGenerator(Sequence):
         if self._shuffle:
             np.random.shuffle(self._indices)
 
+    @staticmethod
+    def _take_windows(windows, samples, channels):
+        """
+        Take the windows of the given samples and channels from a view produced by _time_windows.
+
+        :param windows: ndarray: view of shape (sample, time_step, channel, ...)
+        :param samples: ndarray: sample indices
+        :param channels: ndarray: channel indices
+        :return: ndarray: array of shape (len(samples), time_step, len(channels), ...)
+        """
+        return windows[samples[:, np.newaxis, np.newaxis], np.arange(windows.shape[1])[:, np.newaxis], channels]
+
     def generate(self, samples):
         if len(samples) == 0:
-            samples = np.arange(self._n_sample, dtype=np.int)
+            samples = np.arange(self._n_sample, dtype=np.int64)
         else:
-            samples = np.array(samples, dtype=np.int)
+            samples = np.asarray(samples, dtype=np.int64)
         n_sample = len(samples)
 
-        # Predictors
-        p = np.concatenate([self.array[samples + n * self._interval, self._input_slice][:, np.newaxis]
-                            for n in range(self._input_time_steps)], axis=1)
+        # Predictors; insolation is copied into an extra channel of the same array instead of being concatenated
+        input_steps = self._interval * np.arange(self._input_time_steps)
+        n_channel = self._input_size
         if self._add_insolation:
-            insol = []
-            if self._sequence is not None:
-                for s in range(self._sequence):
-                    insol.append(
-                        np.concatenate(
-                            [self.insolation_array[samples + self._interval * (self._input_time_steps * s + n),
-                                                   np.newaxis, np.newaxis] for n in range(self._input_time_steps)],
-                            axis=1
-                        )
-                    )
-            else:
-                insol.append(
-                    np.concatenate([self.insolation_array[samples + n * self._interval, np.newaxis, np.newaxis]
-                                    for n in range(self._input_time_steps)], axis=1)
-                )
-            p = np.concatenate([p, insol[0]], axis=2)
+            dtype = np.result_type(self.array.dtype, self._insolation_np.dtype)
+        else:
+            dtype = self.array.dtype
+        p = np.empty((n_sample, self._input_time_steps, n_channel + self._add_insolation) + self.array.shape[2:],
+                     dtype=dtype)
+        if self._input_all_channels:
+            _gather_scale(self.array, samples[:, np.newaxis] + input_steps, p[:, :, :n_channel])
+        elif self._input_windows is not None:
+            p[:, :, :n_channel] = self._take_windows(self._input_windows, samples, self._input_channels)
+        else:
+            for n in range(self._input_time_steps):
+                p[:, n, :n_channel] = self.array[samples + n * self._interval, self._input_slice]
+        if self._add_insolation:
+            _gather_scale(self._insolation_np, samples[:, np.newaxis] + input_steps, p[:, :, n_channel:])
+            insol = [np.take(self._insolation_np, samples[:, np.newaxis] + input_steps
+                             + self._interval * self._input_time_steps * s, axis=0)
+                     for s in range(1, self._sequence or 1)]
         p = p.reshape((n_sample, -1))
 
         # Targets, including sequence if desired
         if self._sequence is not None:
             targets = []
             for s in range(self._sequence):
-                t = np.concatenate(
-                    [self.array[samples + self._interval * (self._input_time_steps + self._output_time_steps * s + n),
-                                self._output_slice][:, np.newaxis]
-                     for n in range(self._output_time_steps)],
-                    axis=1
-                )
+                if self._output_windows is not None:
+                    t = self._take_windows(self._output_windows, samples + self._interval * (
+                            self._input_time_steps + self._output_time_steps * s), self._output_channels)
+                else:
+                    t = np.concatenate(
+                        [self.array[samples + self._interval * (self._input_time_steps + self._output_time_steps * s
+                                                                + n), self._output_slice][:, np.newaxis]
+                         for n in range(self._output_time_steps)],
+                        axis=1
+                    )
 
                 t = t.reshape((n_sample, -1))
 
@@ -917,24 +1400,25 @@ class ArrayDataGenerator(Sequence):
 
                 # Format spatial shape for convolutions; also takes care of time axis
                 if self._is_convolutional:
-                    cl = bool(self.channels_last)
-                    self.channels_last = False
-                    p = p.reshape((n_sample,) + self.convolution_shape)
-                    t = t.reshape((n_sample,) + self.output_convolution_shape)
-                    self.channels_last = bool(cl)
+                    p = p.reshape((n_sample,) + self._conv_shape)
+                    t = t.reshape((n_sample,) + self._output_conv_shape)
                 elif self._keep_time_axis:
-                    p = p.reshape((n_sample,) + self.dense_shape)
-                    t = t.reshape((n_sample,) + self.output_dense_shape)
+                    p = p.reshape((n_sample,) + self._dense_shape)
+                    t = t.reshape((n_sample,) + self._output_dense_shape)
 
                 targets.append(t)
 
             # Sequence of inputs (plus insolation) for predictors
             if self._add_insolation:
-                p = [p] + insol[1:]
+                p = [p] + insol
         else:
-            t = np.concatenate([self.array[samples + self._interval * (self._input_time_steps + n),
-                                           np.newaxis, self._output_slice]
-                                for n in range(self._output_time_steps)], axis=1)
+            if self._output_windows is not None:
+                t = self._take_windows(self._output_windows, samples + self._interval * self._input_time_steps,
+                                       self._output_channels)
+            else:
+                t = np.concatenate([self.array[samples + self._interval * (self._input_time_steps + n),
+                                               np.newaxis, self._output_slice]
+                                    for n in range(self._output_time_steps)], axis=1)
 
             t = t.reshape((n_sample, -1))
 
@@ -944,14 +1428,11 @@ class ArrayDataGenerator(Sequence):
 
             # Format spatial shape for convolutions; also takes care of time axis
             if self._is_convolutional:
-                cl = bool(self.channels_last)
-                self.channels_last = False
-                p = p.reshape((n_sample,) + self.convolution_shape)
-                t = t.reshape((n_sample,) + self.output_convolution_shape)
-                self.channels_last = bool(cl)
+                p = p.reshape((n_sample,) + self._conv_shape)
+                t = t.reshape((n_sample,) + self._output_conv_shape)
             elif self._keep_time_axis:
-                p = p.reshape((n_sample,) + self.dense_shape)
-                t = t.reshape((n_sample,) + self.output_dense_shape)
+                p = p.reshape((n_sample,) + self._dense_shape)
+                t = t.reshape((n_sample,) + self._output_dense_shape)
 
             targets = t
 
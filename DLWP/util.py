@@ -332,10 +332,9 @@ def insolation(dates, lat, lon, S=1., daily=False):
     ecc = 0.016715
     om = 282.7 * np.pi / 180.
     beta = np.sqrt(1 - ecc ** 2.)
-    # Get the day of year. Ignore leap days.
-    days = pd.Series(dates)
-    days = days.apply(day_of_year)
-    days_arr = days.values.copy().astype(np.float32)
+    # Get the day of year, for all dates at once. Ignore leap days.
+    dates = pd.DatetimeIndex(np.asarray(dates))
+    days_arr = ((dates.dayofyear - 1) + (dates - dates.normalize()) / pd.Timedelta(days=1)).values.astype(np.float32)
     for d in range(n_dim):
         days_arr = np.expand_dims(days_arr, -1)
     # For daily max values, set the day to 0.5 and the longitude everywhere to 0 (this is approx noon)